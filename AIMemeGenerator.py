@@ -31,6 +31,21 @@ import configparser
 import platform
 import shutil
 import traceback
+import threading
+import queue
+import json
+from base64 import b64encode
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import sqlite3
+import time
+import socket
+import uuid
+import random
+from contextlib import closing
+from abc import ABC, abstractmethod
+import functools
+import inspect
 
 # =============================================== Argument Parser ================================================
 # Parse the arguments at the start of the script
@@ -47,10 +62,27 @@ parser.add_argument("--imagespecialinstructions", help=f"The image special instr
 # These don't need to be specified as true/false, just specifying them will set them to true
 parser.add_argument("--nouserinput", action='store_true', help="Will prevent any user input prompts, and will instead use default values or other arguments.")
 parser.add_argument("--nofilesave", action='store_true', help="If specified, the meme will not be saved to a file, and only returned as virtual file part of memeResultsDictsList.")
+parser.add_argument("--preview", action='store_true', help="Generates quick, low cost preview images (smaller sizes, fewer steps, cheaper models). Good previews can then be regenerated at full quality with --promote.")
+parser.add_argument("--promote", nargs='+', metavar="PREVIEW_FILE", help="Regenerates the given preview meme files at full quality, keeping the same meme text and image prompt.")
+parser.add_argument("--outputvariants", help="Extra resized copies of each meme to create, as comma separated size:format pairs. Size is the longest side in pixels, or 'full'. Example: '512:png,256:jpeg'")
+# Server mode arguments
+parser.add_argument("--serve", action='store_true', help="Runs a local HTTP server with a JSON API for generating memes, instead of generating memes interactively.")
+parser.add_argument("--host", help="The address the server will listen on when using --serve. Default is 127.0.0.1")
+parser.add_argument("--port", help="The port the server will listen on when using --serve. Default is 8000")
+parser.add_argument("--workers", help="The number of memes the server will generate at the same time when using --serve. Default is 2")
+parser.add_argument("--queuesize", help="The maximum number of meme requests that can wait in the server queue before new requests are rejected with 503. Default is 8")
+# Distributed worker mode arguments
+parser.add_argument("--enqueue", action='store_true', help="Adds the memes to the shared job queue to be generated by workers, instead of generating them in this process. Waits for the workers to finish unless --nowait is used.")
+parser.add_argument("--worker", action='store_true', help="Runs as a worker that takes meme jobs from the shared job queue and generates them.")
+parser.add_argument("--jobqueue", help="Location of the shared job queue used by --enqueue and --worker. For the default 'sqlite' backend this is the database file path. Default is 'meme_jobs.db'")
+parser.add_argument("--nowait", action='store_true', help="With --enqueue, exit right after adding the jobs instead of waiting for the workers to finish them. With --collect, only collect the jobs that are already finished.")
+parser.add_argument("--collect", metavar="BATCH_ID", help="Collects the results of a batch added with --enqueue --nowait, waiting for the workers to finish it unless --nowait is used. Collected jobs are removed from the job queue.")
 args = parser.parse_args()
 
 # Create a namedtuple classes
 ApiKeysTupleClass = namedtuple('ApiKeysTupleClass', ['openai_key', 'clipdrop_key', 'stability_key'])
+# Size is the longest side in pixels, or None to keep the full size. Format is a Pillow format name such as 'PNG', 'JPEG' or 'WEBP'
+MemeVariantTupleClass = namedtuple('MemeVariantTupleClass', ['size', 'format'])
 
 # Create custom exceptions
 class NoFontFileError(Exception):
@@ -85,6 +117,20 @@ class InvalidImagePlatformError(Exception):
         self.valid_platforms = valid_platforms
         self.simple_message = message
 
+class UpdateCheckHTTPError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+        self.simple_message = message
+
+class ServerQueueFullError(Exception):
+    def __init__(self, message, queue_size):
+        full_error_message = f"The meme server queue is full ({queue_size} requests waiting). Please try again later."
+        
+        super().__init__(full_error_message)
+        self.queue_size = queue_size
+        self.simple_message = message
+
 # ==============================================================================================
 
 # Construct the system prompt for the chat bot
@@ -158,6 +204,33 @@ def parseBool(string, silent=False):
     else:
         raise ValueError('Not a valid boolean string')
 
+# Converts a string like "512:png, 256:jpeg, full:webp" into a list of MemeVariantTupleClass
+def parse_output_variants(variantsString):
+    variantsList = []
+    if not variantsString:
+        return variantsList
+    
+    for variantString in variantsString.split(','):
+        variantString = variantString.strip()
+        if not variantString:
+            continue
+        sizeString, _, formatString = variantString.partition(':')
+        formatString = (formatString.strip() or "png").upper()
+        if formatString == "JPG":
+            formatString = "JPEG"
+        if formatString not in ["PNG", "JPEG", "WEBP"]:
+            raise ValueError(f'Invalid output variant format "{formatString}". Must be "png", "jpeg", or "webp"')
+        
+        if sizeString.strip().lower() == "full":
+            size = None
+        else:
+            size = int(sizeString)
+            if size <= 0:
+                raise ValueError(f'Invalid output variant size "{sizeString}". Must be a positive number of pixels or "full"')
+        variantsList.append(MemeVariantTupleClass(size, formatString))
+        
+    return variantsList
+
 # Returns a dictionary of the config file
 def get_config(config_file_path):
     config_raw = configparser.ConfigParser()
@@ -246,24 +319,142 @@ def get_api_keys(api_key_filename="api_keys.ini", args=None):
 
     return ApiKeysTupleClass(openai_key, clipdrop_key, stability_key)
 
+# Uses the API keys given as parameters if there are any, otherwise gets them from the config file or command line arguments
+def resolve_api_keys(openai_key=None, clipdrop_key=None, stability_key=None):
+    if not openai_key:
+        return get_api_keys(args=parser.parse_args())
+    return ApiKeysTupleClass(openai_key, clipdrop_key, stability_key)
+
+# ------------ SETTINGS AND ARGUMENTS ------------
+
+# Setting name in settings.ini -> (parameter name it overrides, function to convert the value)
+settingsToParamsMap = {
+    'Text_Model': ('text_model', str),
+    'Temperature': ('temperature', float),
+    'Basic_Instructions': ('basic_instructions', str),
+    'Image_Special_Instructions': ('image_special_instructions', str),
+    'Image_Platform': ('image_platform', lambda value: str(value).lower()),
+    'Image_Quality': ('image_quality', str),
+    'Font_File': ('font_file', str),
+    'Base_File_Name': ('base_file_name', str),
+    'Output_Folder': ('output_folder', str),
+    'Output_Variants': ('output_variants', str),
+    'Release_Channel': ('release_channel', str),
+    'Update_Check_Cache_Hours': ('update_check_cache_hours', float),
+    'Duplicate_Check': ('duplicate_check', parseBool),
+    'Duplicate_Threshold': ('duplicate_threshold', float),
+    'Duplicate_Action': ('duplicate_action', str),
+    'Duplicate_Max_Retries': ('duplicate_max_retries', int),
+    'Duplicate_Check_History': ('duplicate_check_history', parseBool),
+    'Server_Host': ('host', str),
+    'Server_Port': ('port', int),
+    'Server_Workers': ('workers', int),
+    'Server_Queue_Size': ('queue_size', int),
+    'Job_Queue_Backend': ('job_queue_backend', str),
+    'Job_Queue_Location': ('job_queue_location', str),
+    'Job_Max_Attempts': ('job_max_attempts', int),
+    'Job_Lease_Seconds': ('job_lease_seconds', int),
+    'Worker_Idle_Exit_Seconds': ('worker_idle_exit_seconds', int),
+}
+
+# Command line argument -> (parameter name it overrides, function to convert the value). Arguments that are not given are ignored
+argsToParamsMap = {
+    'imageplatform': ('image_platform', lambda value: value.lower()),
+    'temperature': ('temperature', float),
+    'basicinstructions': ('basic_instructions', str),
+    'imagespecialinstructions': ('image_special_instructions', str),
+    'userprompt': ('user_entered_prompt', str),
+    'memecount': ('meme_count', int),
+    'nouserinput': ('noUserInput', lambda value: True),
+    'nofilesave': ('noFileSave', lambda value: True),
+    'outputvariants': ('output_variants', str),
+    'preview': ('image_quality', lambda value: "preview"),
+    'host': ('host', str),
+    'port': ('port', int),
+    'workers': ('workers', int),
+    'queuesize': ('queue_size', int),
+    'jobqueue': ('job_queue_location', str),
+    'nowait': ('wait', lambda value: False),
+}
+
+# Returns a copy of the params dictionary with values from settings.ini (unless Use_This_Config is False), then command line arguments, applied over it.
+# Only parameters that are already in params are changed, so each function only picks up the settings and arguments it uses
+def resolve_settings(params):
+    params = dict(params)
+    
+    settings = get_settings()
+    use_config = settings.get('Use_This_Config', False) # If set to False, will ignore the settings.ini file
+    if use_config:
+        for settingName, (paramName, convertValue) in settingsToParamsMap.items():
+            if paramName in params and settingName in settings:
+                params[paramName] = convertValue(settings[settingName])
+    
+    args = parser.parse_args()
+    for argName, (paramName, convertValue) in argsToParamsMap.items():
+        argValue = getattr(args, argName)
+        if argValue and paramName in params:
+            params[paramName] = convertValue(argValue)
+    
+    return params
+
+# Decorator for the entry point functions (generate, serve, etc). Their parameters are filled in by resolve_settings() before the function runs,
+# so the parameters act as defaults that settings.ini and command line arguments can override
+def uses_settings(entryPointFunction):
+    @functools.wraps(entryPointFunction)
+    def wrapper(*args, **kwargs):
+        boundArguments = inspect.signature(entryPointFunction).bind(*args, **kwargs)
+        boundArguments.apply_defaults()
+        return entryPointFunction(**resolve_settings(boundArguments.arguments))
+    return wrapper
+
 # ------------ VALIDATION ------------
 
+valid_image_platforms = ["openai", "stability", "clipdrop"]
+
+def validate_image_platform(image_platform):
+    if image_platform.lower() not in valid_image_platforms:
+        raise InvalidImagePlatformError(f'Invalid image platform provided.', image_platform, valid_image_platforms)
+
 def validate_api_keys(apiKeys, image_platform):
     if not apiKeys.openai_key:
         raise MissingOpenAIKeyError("No OpenAI API key found.")
 
-    valid_image_platforms = ["openai", "stability", "clipdrop"]
+    validate_image_platform(image_platform)
     image_platform = image_platform.lower()
 
-    if image_platform in valid_image_platforms:
-        if image_platform == "stability" and not apiKeys.stability_key:
-            raise MissingAPIKeyError("No Stability AI API key found.", "Stability AI")
-
-        if image_platform == "clipdrop" and not apiKeys.clipdrop_key:
-            raise MissingAPIKeyError("No ClipDrop API key found.", "ClipDrop")
-
-    else:
-        raise InvalidImagePlatformError(f'Invalid image platform provided.', image_platform, valid_image_platforms)
+    if image_platform == "stability" and not apiKeys.stability_key:
+        raise MissingAPIKeyError("No Stability AI API key found.", "Stability AI")
+
+    if image_platform == "clipdrop" and not apiKeys.clipdrop_key:
+        raise MissingAPIKeyError("No ClipDrop API key found.", "ClipDrop")
+
+# Image generation settings for each quality tier. 'preview' is for quickly drafting many memes, which can later be promoted to 'full' quality
+# Stability AI uses the same engine (set in initialize_api_clients) and size in both tiers, only fewer steps, so promoting with the preview's seed gives a similar (more detailed) image.
+# OpenAI has no seed, so a promoted OpenAI meme only keeps the meme text and image prompt. ClipDrop's text-to-image API has no size, quality, or seed options, so it is the same in both tiers
+imageQualityPresets = {
+    "full": {
+        "openai": {"model": "dall-e-3", "size": "1024x1024"},
+        "stability": {"steps": 30, "width": 1024, "height": 1024},
+    },
+    "preview": {
+        "openai": {"model": "dall-e-2", "size": "256x256"},
+        "stability": {"steps": 15, "width": 1024, "height": 1024},
+    },
+}
+
+# An invalid duplicate action only prints a warning, because the duplicate check is not worth stopping for
+def validate_duplicate_action(duplicate_action):
+    duplicate_action = duplicate_action.lower()
+    if duplicate_action not in ["regenerate", "skip"]:
+        print(f'\n  WARNING:  Invalid Duplicate_Action "{duplicate_action}", using "regenerate" instead.')
+        duplicate_action = "regenerate"
+    return duplicate_action
+
+def validate_image_quality(image_quality):
+    image_quality = image_quality.lower()
+    if image_quality not in imageQualityPresets:
+        raise ValueError(f'Invalid image quality "{image_quality}". Valid image qualities are: {list(imageQualityPresets)}')
+    return image_quality
 
 def initialize_api_clients(apiKeys, image_platform):
     if apiKeys.openai_key:
@@ -286,8 +477,8 @@ def initialize_api_clients(apiKeys, image_platform):
 
 # =============================================== Functions ================================================
 
-# Sets the name and path of the file to be used
-def set_file_path(baseName, outputFolder):
+# Sets the name and path of the file to be used. With reserveFile, an empty file is created right away so other processes writing to the same folder can't pick the same name
+def set_file_path(baseName, outputFolder, reserveFile=False):
     def get_next_counter():
         # Check existing files in the directory
         existing_files = glob.glob(os.path.join(outputFolder, baseName + "_" + timestamp + "_*.png"))
@@ -308,7 +499,7 @@ def set_file_path(baseName, outputFolder):
     
     # If the output folder does not exist, create it
     if not os.path.exists(outputFolder):
-        os.makedirs(outputFolder)
+        os.makedirs(outputFolder, exist_ok=True)
     
     # Get the next counter number
     file_counter = get_next_counter()
@@ -317,8 +508,23 @@ def set_file_path(baseName, outputFolder):
     fileName = baseName + "_" + timestamp + "_" + str(file_counter) + ".png"
     filePath = os.path.join(outputFolder, fileName)
     
+    # O_EXCL fails if the file already exists, in which case another process took that name first, so try the next counter
+    while reserveFile:
+        try:
+            os.close(os.open(filePath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            file_counter += 1
+            fileName = baseName + "_" + timestamp + "_" + str(file_counter) + ".png"
+            filePath = os.path.join(outputFolder, fileName)
+    
     return filePath, fileName
 
+# Removes a file reserved by set_file_path(reserveFile=True), for when the meme could not be created after all
+def remove_reserved_file(filePath, noFileSave=False):
+    if not noFileSave and os.path.isfile(filePath):
+        os.remove(filePath)
+
     
 # Write or append log file containing the user user message, chat bot meme text, and chat bot image prompt for each meme
 def write_log_file(userPrompt, AiMemeDict, filePath, logFolder, basic, special, platform):
@@ -334,105 +540,128 @@ def write_log_file(userPrompt, AiMemeDict, filePath, logFolder, basic, special,
                        Chat Bot Image Prompt: {AiMemeDict['image_prompt']}
                        Image Generation Platform: {platform}
                        \n"""))
-        
-        
-def check_for_update(currentVersion=version, updateReleaseChannel=None, silentCheck=False):
-    isUpdateAvailable = False
-    print("\nGetting info about latest updates...\n")
-
-    try:
-        if updateReleaseChannel.lower() == "stable":
-            response = requests.get("https://api.github.com/repos/ThioJoe/Full-Stack-AI-Meme-Generator/releases/latest")
-        elif updateReleaseChannel.lower() == "all":
-            response = requests.get("https://api.github.com/repos/ThioJoe/Full-Stack-AI-Meme-Generator/releases")
-
-        if response.status_code != 200:
-            if response.status_code == 403:
-                if silentCheck == False:
-                    print(f"\nError [U-4]: Got an 403 (ratelimit_reached) when attempting to check for update.")
-                    print(f"This means you have been rate limited by github.com. Please try again in a while.\n")
-                else:
-                    print(f"\nError [U-4]: Got an 403 (ratelimit_reached) when attempting to check for update.")
-                return None
-
-            else:
-                if silentCheck == False:
-                    print(f"Error [U-3]: Got non 200 status code (got: {response.status_code}) when attempting to check for update.\n")
-                    print(f"If this keeps happening, you may want to report the issue here: https://github.com/ThioJoe/Full-Stack-AI-Meme-Generator/issues")
-                else:
-                    print(f"Error [U-3]: Got non 200 status code (got: {response.status_code}) when attempting to check for update.\n")
-                return None
-
-        else:
-            # assume 200 response (good)
-            if updateReleaseChannel.lower() == "stable":
-                latestVersion = response.json()["name"]
-                isBeta = False
-            elif updateReleaseChannel.lower() == "all":
-                latestVersion = response.json()[0]["name"]
-                # check if latest version is a beta. 
-                # if it is continue, else check for another beta with a higher version in the 10 newest releases 
-                isBeta = response.json()[0]["prerelease"]
-                if (isBeta == False): 
-                    for i in range(9):
-                        # add a "+ 1" to index to not count the first release (already checked)
-                        latestVersion2 = response.json()[i + 1]["name"]
-                        # make sure the version is higher than the current version
-                        if parse_version(latestVersion2) > parse_version(latestVersion):
-                            # update original latest version to the new version
-                            latestVersion = latestVersion2
-                            isBeta = response.json()[i + 1]["prerelease"]
-                            # exit loop
-                            break
-
-    except OSError as ox:
-        if "WinError 10013" in str(ox):
-            print(f"WinError 10013: The OS blocked the connection to GitHub. Check your firewall settings.\n")
-        else:
-            print(f"Unknown OSError Error occurred while checking for updates\n")
-        return None
-    except Exception as e:
-        if silentCheck == False:
-            print(str(e) + "\n")
-            print(f"Error [Code U-1]: Problem while checking for updates. See above error for more details.\n")
-            print("If this keeps happening, you may want to report the issue here: https://github.com/ThioJoe/Full-Stack-AI-Meme-Generator/issues")
-        elif silentCheck == True:
-            print(f"Error [Code U-1]: Unknown problem while checking for updates. See above error for more details.\n")
-        return None
 
-    if parse_version(latestVersion) > parse_version(currentVersion):
-        if isBeta == True:
-            isUpdateAvailable = "beta"
-        else:
-            isUpdateAvailable = True
 
-        if silentCheck == False:
-            print("----------------------------- UPDATE AVAILABLE -------------------------------------------")
-            if isBeta == True:
-                print(f" A new beta version is available! To see what's new visit: https://github.com/ThioJoe/Full-Stack-AI-Meme-Generator/releases ")
-            else:
-                print(f" A new version is available! To see what's new visit: https://github.com/ThioJoe/Full-Stack-AI-Meme-Generator/releases ")
-            print(f"     > Current Version: {currentVersion}")
-            print(f"     > Latest Version: {latestVersion}")
-            if isBeta == True:
-                print("(To stop receiving beta releases, change the 'release_channel' setting in the config file)")
-            print("------------------------------------------------------------------------------------------")
-            
-        elif silentCheck == True:
-            return isUpdateAvailable
+# Appends the details of a preview meme to preview_log.jsonl in the output folder (one JSON object per line), so it can be promoted to full quality later
+def write_preview_record(logFolder, previewRecordDict):
+    with open(os.path.join(logFolder, "preview_log.jsonl"), "a", encoding='utf-8') as preview_log_file:
+        preview_log_file.write(json.dumps(previewRecordDict) + "\n")
+
+# Returns a dictionary of preview records from preview_log.jsonl, by file name
+def read_preview_records(logFolder):
+    previewRecordsDict = {}
+    previewLogPath = os.path.join(logFolder, "preview_log.jsonl")
+    if not os.path.isfile(previewLogPath):
+        return previewRecordsDict
+    with open(previewLogPath, "r", encoding='utf-8') as preview_log_file:
+        for line in preview_log_file:
+            if line.strip():
+                previewRecordDict = json.loads(line)
+                previewRecordsDict[previewRecordDict["file_name"]] = previewRecordDict
+    return previewRecordsDict
+        
+        
+# Gets the latest release version from GitHub. Returns a tuple of (latestVersion, isBeta). Raises UpdateCheckHTTPError for non 200 responses
+def fetch_latest_release(updateReleaseChannel, timeout=5):
+    if updateReleaseChannel.lower() == "stable":
+        response = requests.get("https://api.github.com/repos/ThioJoe/Full-Stack-AI-Meme-Generator/releases/latest", timeout=timeout)
+    elif updateReleaseChannel.lower() == "all":
+        # Only the 10 newest releases are checked, so don't download the whole list
+        response = requests.get("https://api.github.com/repos/ThioJoe/Full-Stack-AI-Meme-Generator/releases", params={"per_page": 10}, timeout=timeout)
+    else:
+        raise ValueError(f'Invalid release channel "{updateReleaseChannel}"')
+
+    if response.status_code != 200:
+        raise UpdateCheckHTTPError(f"Got status code {response.status_code} when checking for update.", response.status_code)
+
+    if updateReleaseChannel.lower() == "stable":
+        latestVersion = response.json()["name"]
+        isBeta = False
+    elif updateReleaseChannel.lower() == "all":
+        releasesList = response.json()
+        latestVersion = releasesList[0]["name"]
+        # check if latest version is a beta. 
+        # if it is continue, else check for another beta with a higher version in the 10 newest releases 
+        isBeta = releasesList[0]["prerelease"]
+        if (isBeta == False): 
+            # start at 1 to not count the first release (already checked)
+            for release in releasesList[1:10]:
+                # make sure the version is higher than the current version
+                if parse_version(release["name"]) > parse_version(latestVersion):
+                    # update original latest version to the new version
+                    latestVersion = release["name"]
+                    isBeta = release["prerelease"]
+                    # exit loop
+                    break
 
-    elif parse_version(latestVersion) == parse_version(currentVersion):
-        if silentCheck == False:
-            #print(f"\nYou have the latest version: " + currentVersion)
-            pass
-        return False
+    return latestVersion, isBeta
+
+# Same as fetch_latest_release, but uses the result saved in the cache file if it is newer than cacheTTLHours, to avoid GitHub's rate limit on repeated launches
+def get_latest_release(updateReleaseChannel, timeout=5, cacheTTLHours=12, cacheFilePath="update_check_cache.json"):
+    if cacheTTLHours:
+        try:
+            with open(cacheFilePath, "r", encoding='utf-8') as cacheFile:
+                cacheDict = json.load(cacheFile)
+            if cacheDict["channel"] == updateReleaseChannel.lower() and time.time() - cacheDict["checked"] < cacheTTLHours * 3600:
+                return cacheDict["latest_version"], cacheDict["is_beta"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass # No usable cache, so check online
+
+    latestVersion, isBeta = fetch_latest_release(updateReleaseChannel, timeout)
+
+    if cacheTTLHours:
+        try:
+            with open(cacheFilePath, "w", encoding='utf-8') as cacheFile:
+                json.dump({"channel": updateReleaseChannel.lower(), "latest_version": latestVersion, "is_beta": isBeta, "checked": time.time()}, cacheFile)
+        except OSError:
+            pass # Not being able to save the cache shouldn't stop anything
+
+    return latestVersion, isBeta
+
+def print_update_notice(currentVersion, latestVersion, isBeta):
+    print("----------------------------- UPDATE AVAILABLE -------------------------------------------")
+    if isBeta == True:
+        print(f" A new beta version is available! To see what's new visit: https://github.com/ThioJoe/Full-Stack-AI-Meme-Generator/releases ")
     else:
-        if silentCheck == False:
-            #print("\nNo newer release available - Your Version: " + currentVersion + "    --    Latest Version: " + latestVersion)
-            pass
-        return False
+        print(f" A new version is available! To see what's new visit: https://github.com/ThioJoe/Full-Stack-AI-Meme-Generator/releases ")
+    print(f"     > Current Version: {currentVersion}")
+    print(f"     > Latest Version: {latestVersion}")
+    if isBeta == True:
+        print("(To stop receiving beta releases, change the 'release_channel' setting in the config file)")
+    print("------------------------------------------------------------------------------------------")
+
+# Checks for updates in a background thread, so a slow or offline network doesn't hold up startup. Call show_notice() once the memes are done
+class BackgroundUpdateCheck:
+    def __init__(self, currentVersion, updateReleaseChannel, timeout=5, cacheTTLHours=12):
+        self.currentVersion = currentVersion
+        self.updateReleaseChannel = updateReleaseChannel
+        self.timeout = timeout
+        self.cacheTTLHours = cacheTTLHours
+        self.latestRelease = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        
+    def start(self):
+        self.thread.start()
+        
+    def run(self):
+        try:
+            self.latestRelease = get_latest_release(self.updateReleaseChannel, self.timeout, self.cacheTTLHours)
+        except Exception:
+            pass # Errors are not shown, the update check should never get in the way of making memes
     
-    return isUpdateAvailable
+    # Prints the update notice if an update is available. Waits at most waitSeconds for the check to finish.
+    # Returns True (or "beta") if an update is available, False if not, or None if the check failed or didn't finish in time
+    def show_notice(self, waitSeconds=1):
+        self.thread.join(waitSeconds)
+        if not self.latestRelease:
+            return None
+        
+        latestVersion, isBeta = self.latestRelease
+        if parse_version(latestVersion) > parse_version(self.currentVersion):
+            print()
+            print_update_notice(self.currentVersion, latestVersion, isBeta)
+            return "beta" if isBeta else True
+        return False
 
 # Gets the meme text and image prompt from the message sent by the chat bot
 def parse_meme(message):
@@ -469,8 +698,78 @@ def send_and_receive_message(openai_api, text_model, userMessage, conversationTe
 
     return chatResponseMessage
 
+# Keeps the meme text of memes already made, so near-duplicates can be caught before paying for an image. Runs locally, no network requests
+class MemeDuplicateIndex:
+    def __init__(self, threshold=0.8, ngram_size=3):
+        self.threshold = threshold
+        self.ngram_size = ngram_size
+        self.memeTextsList = []
+        self.shinglesList = [] # (meme text shingles, image prompt shingles) for each meme
+    
+    # Lowercase, remove punctuation, and collapse whitespace, so small formatting differences don't count as different memes
+    @staticmethod
+    def normalize(text):
+        text = text.lower().translate(str.maketrans('', '', string.punctuation))
+        return " ".join(text.split())
+    
+    # Set of overlapping character n-grams ("shingles") of the text. Empty if nothing is left after normalizing, for example text that is only punctuation
+    def get_shingles(self, text):
+        text = self.normalize(text or "")
+        if not text:
+            return set()
+        if len(text) <= self.ngram_size:
+            return {text}
+        return {text[i:i + self.ngram_size] for i in range(len(text) - self.ngram_size + 1)}
+    
+    def add(self, meme_text, image_prompt):
+        self.memeTextsList.append(meme_text)
+        self.shinglesList.append((self.get_shingles(meme_text), self.get_shingles(image_prompt)))
+    
+    # Loads the meme text and image prompt of previous memes from the log file, if there is one
+    def load_log_file(self, logFolder):
+        logFilePath = os.path.join(logFolder, "log.txt")
+        if not os.path.isfile(logFilePath):
+            return
+        meme_text = None
+        with open(logFilePath, "r", encoding='utf-8') as log_file:
+            for line in log_file:
+                if line.startswith("Chat Bot Meme Text: "):
+                    meme_text = line[len("Chat Bot Meme Text: "):].strip()
+                elif line.startswith("Chat Bot Image Prompt: ") and meme_text is not None:
+                    self.add(meme_text, line[len("Chat Bot Image Prompt: "):].strip())
+                    meme_text = None
+    
+    # Similarity of a meme to an existing one: the average Jaccard similarity of the meme text shingles and of the image prompt shingles.
+    # A part that is empty on either side is left out, so empty text can't match other empty text. If both parts are left out, the similarity is 0
+    @staticmethod
+    def get_similarity(newShinglesPair, existingShinglesPair):
+        similaritiesList = [len(newShingles & existingShingles) / len(newShingles | existingShingles) for newShingles, existingShingles in zip(newShinglesPair, existingShinglesPair) if newShingles and existingShingles]
+        if not similaritiesList:
+            return 0
+        return sum(similaritiesList) / len(similaritiesList)
+    
+    # Returns the meme text of the most similar existing meme if it is at or above the threshold, otherwise None
+    def find_duplicate(self, meme_text, image_prompt):
+        newShinglesPair = (self.get_shingles(meme_text), self.get_shingles(image_prompt))
+        bestSimilarity = 0
+        bestMatch = None
+        for existingText, existingShinglesPair in zip(self.memeTextsList, self.shinglesList):
+            similarity = self.get_similarity(newShinglesPair, existingShinglesPair)
+            if similarity > bestSimilarity:
+                bestSimilarity = similarity
+                bestMatch = existingText
+        
+        if bestSimilarity >= self.threshold:
+            return bestMatch
+        return None
+
 
 def create_meme(image_path, top_text, filePath, fontFile, noFileSave=False, min_scale=0.05, buffer_scale=0.03, font_scale=1):
+    memeImage = compose_meme(image_path, top_text, fontFile, min_scale, buffer_scale, font_scale)
+    return save_meme(memeImage, filePath, noFileSave)
+
+# Draws the meme text above the image and returns the finished image, without encoding or saving it. Use this with save_meme() and create_meme_variants() to make resized copies from the same in-memory image
+def compose_meme(image_path, top_text, fontFile, min_scale=0.05, buffer_scale=0.03, font_scale=1):
     print("Creating meme image...")
     
     # Load the image. Can be a path or a file-like object such as IO.BytesIO virtual file
@@ -527,20 +826,64 @@ def create_meme(image_path, top_text, filePath, fontFile, noFileSave=False, min_
     new_img.paste(band, (0,0))
     new_img.paste(image, (0, band_height))
 
+    return new_img
+
+# Encodes the meme image once as a virtual file, and writes those same bytes to the file instead of encoding it again
+def save_meme(memeImage, filePath, noFileSave=False):
+    virtualMemeFile = io.BytesIO()
+    memeImage.save(virtualMemeFile, format="PNG")
+    
     if not noFileSave:
         # Save the result to a file
-        new_img.save(filePath)
-        
-    # Return image as virtual file
-    virtualMemeFile = io.BytesIO()
-    new_img.save(virtualMemeFile, format="PNG")
+        with open(filePath, "wb") as memeFile:
+            memeFile.write(virtualMemeFile.getvalue())
     
     return virtualMemeFile
+
+# Variant files are named after the main meme file, for example: meme_2023-07-13-15-34_1-512px.png. A size of None is the full size
+def get_variant_file_path(filePath, size, imageFormat):
+    sizeLabel = f"{size}px" if size else "full"
+    extension = "jpg" if imageFormat == "JPEG" else imageFormat.lower()
+    return os.path.splitext(filePath)[0] + f"-{sizeLabel}.{extension}"
+
+# Creates resized copies of the finished meme image. Sizes are made largest first, each from the previous one, so every step only shrinks a smaller image
+def create_meme_variants(memeImage, filePath, output_variants, noFileSave=False):
+    # Order of the returned list matches the order of output_variants
+    variantsList = [None] * len(output_variants)
+    sortedIndexes = sorted(range(len(output_variants)), key=lambda i: output_variants[i].size or float('inf'), reverse=True)
+    
+    currentImage = memeImage
+    for index in sortedIndexes:
+        variant = output_variants[index]
+        
+        if variant.size and max(currentImage.size) > variant.size:
+            # Keep the aspect ratio, with the longest side set to the variant size
+            scale = variant.size / max(memeImage.size)
+            newSize = (max(1, round(memeImage.width * scale)), max(1, round(memeImage.height * scale)))
+            # reducing_gap lets Pillow do a fast integer reduce first, before the final high quality resize
+            currentImage = currentImage.resize(newSize, Image.LANCZOS, reducing_gap=2.0)
+        
+        # JPEG does not support transparency
+        imageToSave = currentImage.convert("RGB") if variant.format == "JPEG" else currentImage
+        virtualVariantFile = io.BytesIO()
+        imageToSave.save(virtualVariantFile, format=variant.format)
+        
+        # Images are never enlarged, so a size bigger than the meme is labeled with the size it actually has
+        variantSize = max(currentImage.size) if variant.size else None
+        variantFilePath = get_variant_file_path(filePath, variantSize, variant.format)
+        if not noFileSave:
+            with open(variantFilePath, "wb") as variantFile:
+                variantFile.write(virtualVariantFile.getvalue())
+        
+        variantsList[index] = {"size": variantSize, "format": variant.format, "file_path": os.path.abspath(variantFilePath), "file_name": os.path.basename(variantFilePath), "virtual_file": virtualVariantFile}
+    
+    return variantsList
     
 
-def image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api=None):
+def image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api=None, image_quality="full", seed=None):
     if platform == "openai":
-        openai_response = openai_api.images.generate(model="dall-e-3", prompt=image_prompt, n=1, size="1024x1024", response_format="b64_json")
+        openaiPreset = imageQualityPresets[image_quality]["openai"]
+        openai_response = openai_api.images.generate(model=openaiPreset["model"], prompt=image_prompt, n=1, size=openaiPreset["size"], response_format="b64_json")
         # Convert image data to virtual file
         image_data = b64decode(openai_response.data[0].model_dump()["b64_json"])
         virtual_image_file = io.BytesIO()
@@ -548,14 +891,15 @@ def image_generation_request(apiKeys, image_prompt, platform, openai_api, stabil
         virtual_image_file.write(image_data)
     
     if platform == "stability" and stability_api:
+        stabilityPreset = imageQualityPresets[image_quality]["stability"]
         # Set up our initial generation parameters.
         stability_response = stability_api.generate(
             prompt=image_prompt,
-            #seed=992446758, # If a seed is provided, the resulting generated image will be deterministic.
-            steps=30,       # Amount of inference steps performed on image generation. Defaults to 30.
+            seed=seed, # If a seed is provided, the resulting generated image will be deterministic.
+            steps=stabilityPreset["steps"],       # Amount of inference steps performed on image generation. Defaults to 30.
             cfg_scale=7.0,  # Influences how strongly your generation is guided to match your prompt. Setting this value higher increases the strength in which it tries to match your prompt. Defaults to 7.0 if not specified.
-            width=1024, # Generation width, if not included defaults to 512 or 1024 depending on the engine.
-            height=1024, # Generation height, if not included defaults to 512 or 1024 depending on the engine.
+            width=stabilityPreset["width"], # Generation width, if not included defaults to 512 or 1024 depending on the engine.
+            height=stabilityPreset["height"], # Generation height, if not included defaults to 512 or 1024 depending on the engine.
             samples=1, # Number of images to generate, defaults to 1 if not included.
             sampler=generation.SAMPLER_K_DPMPP_2M   # Choose which sampler we want to denoise our generation with. Defaults to k_dpmpp_2m if not specified. Clip Guidance only supports ancestral samplers.
                                                     # (Available Samplers: ddim, plms, k_euler, k_euler_ancestral, k_heun, k_dpm_2, k_dpm_2_ancestral, k_dpmpp_2s_ancestral, k_lms, k_dpmpp_2m, k_dpmpp_sde)
@@ -587,9 +931,101 @@ def image_generation_request(apiKeys, image_prompt, platform, openai_api, stabil
 
     return virtual_image_file
 
+# Lock used so that lines appended to the log files by concurrent server workers don't get mixed together. File names are kept unique by set_file_path(reserveFile=True) instead
+fileOutputLock = threading.Lock()
+
+# Runs the full pipeline for a single meme: chat bot text, image generation, and combining them into the final meme
+def generate_single_meme(apiKeys, openai_api, stability_api, text_model, temperature, userEnteredPrompt, conversation, image_platform, base_file_name, output_folder, font_file, basic_instructions, image_special_instructions, noFileSave=False, output_variants=None, duplicateIndex=None, duplicate_action="regenerate", duplicate_max_retries=2, image_quality="full"):
+    # Send request to chat bot to generate meme text and image prompt
+    chatResponse = send_and_receive_message(openai_api, text_model, userEnteredPrompt, conversation, temperature)
+
+    # Take chat message and convert to dictionary with meme_text and image_prompt
+    memeDict = parse_meme(chatResponse)
+    image_prompt = memeDict['image_prompt']
+    meme_text = memeDict['meme_text']
+    
+    # Check for near-duplicates before spending anything on the image
+    if duplicateIndex is not None:
+        retries = 0
+        duplicateText = duplicateIndex.find_duplicate(meme_text, image_prompt)
+        while duplicateText is not None and duplicate_action == "regenerate" and retries < duplicate_max_retries:
+            retries += 1
+            print(f"\n   Meme Text:  {meme_text}")
+            print(f"   (Too similar to an existing meme, regenerating - attempt {retries} of {duplicate_max_retries})")
+            retryMessage = f'{userEnteredPrompt} (Make it different from this meme that was already made: "{duplicateText}")'
+            chatResponse = send_and_receive_message(openai_api, text_model, retryMessage, conversation, temperature)
+            memeDict = parse_meme(chatResponse)
+            image_prompt = memeDict['image_prompt']
+            meme_text = memeDict['meme_text']
+            duplicateText = duplicateIndex.find_duplicate(meme_text, image_prompt)
+        
+        # Still a duplicate after any retries, so skip it
+        if duplicateText is not None:
+            print(f"\n   Meme Text:  {meme_text}")
+            print(f"   (Skipped because it is too similar to an existing meme: \"{duplicateText}\")")
+            return None
+        
+        duplicateIndex.add(meme_text, image_prompt)
+
+    # Print the meme text and image prompt
+    print("\n   Meme Text:  " + meme_text)
+    print("   Image Prompt:  " + image_prompt)
+
+    # Send image prompt to image generator and get image back (Using DALL·E API)
+    # Stability AI is the only platform that takes a seed. Choosing it here means it can be saved, so a preview can be promoted with the same seed
+    seed = random.randrange(2**32) if image_platform == "stability" else None
+    
+    return render_meme(
+        apiKeys=apiKeys,
+        openai_api=openai_api,
+        stability_api=stability_api,
+        meme_text=meme_text,
+        image_prompt=image_prompt,
+        userEnteredPrompt=userEnteredPrompt,
+        image_platform=image_platform,
+        base_file_name=base_file_name,
+        output_folder=output_folder,
+        font_file=font_file,
+        basic_instructions=basic_instructions,
+        image_special_instructions=image_special_instructions,
+        noFileSave=noFileSave,
+        output_variants=output_variants,
+        image_quality=image_quality,
+        seed=seed,
+    )
+
+# Generates the image for meme text and an image prompt that are already decided, then makes the meme, saves it (with any variants), and writes the logs.
+# Used by generate_single_meme() after the chat request, and by promote_memes() with the text and prompt of a preview meme
+def render_meme(apiKeys, openai_api, stability_api, meme_text, image_prompt, userEnteredPrompt, image_platform, base_file_name, output_folder, font_file, basic_instructions, image_special_instructions, noFileSave=False, output_variants=None, image_quality="full", seed=None):
+    print("\nSending image creation request..." if image_quality == "full" else f"\nSending image creation request ({image_quality} quality)...")
+    virtual_image_file = image_generation_request(apiKeys, image_prompt, image_platform, openai_api, stability_api, image_quality, seed)
+
+    # Combine the meme text and image into a meme
+    filePath,fileName = set_file_path(base_file_name, output_folder, reserveFile=not noFileSave)
+    try:
+        memeImage = compose_meme(virtual_image_file, meme_text, fontFile=font_file)
+        virtualMemeFile = save_meme(memeImage, filePath, noFileSave)
+        variantsList = create_meme_variants(memeImage, filePath, output_variants or [], noFileSave)
+    except Exception:
+        # Don't leave the reserved (empty or partly written) file behind
+        remove_reserved_file(filePath, noFileSave)
+        raise
+    if not noFileSave:
+        with fileOutputLock:
+            # Write the user message, meme text, and image prompt to a log file
+            write_log_file(userEnteredPrompt, {"meme_text": meme_text, "image_prompt": image_prompt}, filePath, output_folder, basic_instructions, image_special_instructions, image_platform if image_quality == "full" else f"{image_platform} ({image_quality})")
+            # Save what is needed to promote this meme to full quality later
+            if image_quality == "preview":
+                write_preview_record(output_folder, {"file_name": fileName, "meme_text": meme_text, "image_prompt": image_prompt, "image_platform": image_platform, "seed": seed, "user_prompt": userEnteredPrompt, "basic_instructions": basic_instructions, "image_special_instructions": image_special_instructions})
+
+    absoluteFilePath = os.path.abspath(filePath)
+
+    return {"meme_text": meme_text, "image_prompt": image_prompt, "file_path": absoluteFilePath, "virtual_meme_file": virtualMemeFile, "file_name": fileName, "variants": variantsList, "seed": seed, "image_quality": image_quality}
+
 # ==================== RUN ====================
 
-# Set default values for parameters to those at top of script, but can be overridden by command line arguments or by being set when called from another script
+# Set default values for parameters to those at top of script, but can be overridden by settings.ini, command line arguments, or by being set when called from another script
+@uses_settings
 def generate(
     text_model="gpt-4",
     temperature=1.0,
@@ -606,51 +1042,39 @@ def generate(
     clipdrop_key=None,
     noUserInput=False,
     noFileSave=False,
-    release_channel="all"
+    release_channel="all",
+    output_variants=None,
+    duplicate_check=True,
+    duplicate_threshold=0.8,
+    duplicate_action="regenerate",
+    duplicate_max_retries=2,
+    duplicate_check_history=False,
+    update_check_cache_hours=12,
+    image_quality="full"
 ):
-    
-    # Load default settings from settings.ini file. Will be overridden by command line arguments, or ignored if Use_This_Config is set to False
-    settings = get_settings()
-    use_config = settings.get('Use_This_Config', False) # If set to False, will ignore the settings.ini file
-    if use_config:
-        text_model = settings.get('Text_Model', text_model)
-        temperature = float(settings.get('Temperature', temperature))
-        basic_instructions = settings.get('Basic_Instructions', basic_instructions)
-        image_special_instructions = settings.get('Image_Special_Instructions', image_special_instructions)
-        image_platform = settings.get('Image_Platform', image_platform)
-        font_file = settings.get('Font_File', font_file)
-        base_file_name = settings.get('Base_File_Name', base_file_name)
-        output_folder = settings.get('Output_Folder', output_folder)
-        release_channel = settings.get('Release_Channel', release_channel)
-    
-    # Parse the arguments
+    # Parse the arguments. Settings and arguments have already been applied to the parameters by @uses_settings, these are only needed for the user input section below
     args = parser.parse_args()
+    
+    # Check the image quality first, because preview memes also get a different file name
+    try:
+        image_quality = validate_image_quality(image_quality)
+    except ValueError as vx:
+        print(f"\n  ERROR:  {vx}")
+        if not noUserInput:
+            input("\nPress Enter to exit...")
+        sys.exit()
+    # Preview memes get their own file names, so they are easy to tell apart from full quality memes
+    if image_quality == "preview":
+        base_file_name = base_file_name + "_preview"
 
     # If API Keys not provided as parameters, get them from config file or command line arguments
-    if not openai_key:
-        apiKeys = get_api_keys(args=args)
-    else:
-        apiKeys = ApiKeysTupleClass(openai_key, clipdrop_key, stability_key)
+    apiKeys = resolve_api_keys(openai_key, clipdrop_key, stability_key)
         
     # Validate api keys
     validate_api_keys(apiKeys, image_platform)
     # Initialize api clients
     stability_api, openai_api = initialize_api_clients(apiKeys, image_platform)
 
-    # Check if any settings arguments, and replace the default values with the args if so. To run automated from command line, specify at least 1 argument.
-    if args.imageplatform:
-        image_platform = args.imageplatform
-    if args.temperature:
-        temperature = float(args.temperature)
-    if args.basicinstructions:
-        basic_instructions = args.basicinstructions
-    if args.imagespecialinstructions:
-        image_special_instructions = args.imagespecialinstructions
-    if args.nofilesave:
-        noFileSave=True
-    if args.nouserinput:
-        noUserInput=True
-
     systemPrompt = construct_system_prompt(basic_instructions, image_special_instructions)
     conversation = [{"role": "system", "content": systemPrompt}]
 
@@ -663,12 +1087,22 @@ def generate(
             input("\nPress Enter to exit...")
         sys.exit()
     
-    # Check for updates
+    # Output variants can be given as a string from settings or arguments, or as a list of MemeVariantTupleClass when called from another script
+    if isinstance(output_variants, str):
+        try:
+            output_variants = parse_output_variants(output_variants)
+        except ValueError as vx:
+            print(f"\n  ERROR:  {vx}")
+            if not noUserInput:
+                input("\nPress Enter to exit...")
+            sys.exit()
+    
+    # Check for updates in the background, the notice is shown after the memes are generated
+    updateCheck = None
     if not noUserInput:
         if release_channel.lower() == "all" or release_channel.lower() == "stable":
-            updateAvailable = check_for_update(version, release_channel, silentCheck=False)
-            if updateAvailable:
-                input("\nPress Enter to continue...")
+            updateCheck = BackgroundUpdateCheck(version, release_channel, cacheTTLHours=update_check_cache_hours)
+            updateCheck.start()
                 
     # Clear console
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -705,38 +1139,42 @@ def generate(
             
     # ----------------------------------------------------------------------------------------------------
 
-    def single_meme_generation_loop():
-        # Send request to chat bot to generate meme text and image prompt
-        chatResponse = send_and_receive_message(openai_api, text_model, userEnteredPrompt, conversation, temperature)
-
-        # Take chat message and convert to dictionary with meme_text and image_prompt
-        memeDict = parse_meme(chatResponse)
-        image_prompt = memeDict['image_prompt']
-        meme_text = memeDict['meme_text']
-
-        # Print the meme text and image prompt
-        print("\n   Meme Text:  " + meme_text)
-        print("   Image Prompt:  " + image_prompt)
-
-        # Send image prompt to image generator and get image back (Using DALL·E API)
-        print("\nSending image creation request...")
-        virtual_image_file = image_generation_request(apiKeys, image_prompt, image_platform, openai_api, stability_api)
+    # Set up the near-duplicate check for this batch, optionally including memes from previous runs in the log file
+    duplicateIndex = None
+    if duplicate_check:
+        duplicate_action = validate_duplicate_action(duplicate_action)
+        duplicateIndex = MemeDuplicateIndex(threshold=duplicate_threshold)
+        if duplicate_check_history:
+            duplicateIndex.load_log_file(output_folder)
 
-        # Combine the meme text and image into a meme
-        filePath,fileName = set_file_path(base_file_name, output_folder)
-        virtualMemeFile = create_meme(virtual_image_file, meme_text, filePath, noFileSave=noFileSave,fontFile=font_file)
-        if not noFileSave:
-            # Write the user message, meme text, and image prompt to a log file
-            write_log_file(userEnteredPrompt, memeDict, filePath, output_folder, basic_instructions, image_special_instructions, image_platform)
-        
-        absoluteFilePath = os.path.abspath(filePath)
-        
-        return {"meme_text": meme_text, "image_prompt": image_prompt, "file_path": absoluteFilePath, "virtual_meme_file": virtualMemeFile, "file_name": fileName}
+    def single_meme_generation_loop():
+        return generate_single_meme(
+            apiKeys=apiKeys,
+            openai_api=openai_api,
+            stability_api=stability_api,
+            text_model=text_model,
+            temperature=temperature,
+            userEnteredPrompt=userEnteredPrompt,
+            conversation=conversation,
+            image_platform=image_platform,
+            base_file_name=base_file_name,
+            output_folder=output_folder,
+            font_file=font_file,
+            basic_instructions=basic_instructions,
+            image_special_instructions=image_special_instructions,
+            noFileSave=noFileSave,
+            output_variants=output_variants,
+            duplicateIndex=duplicateIndex,
+            duplicate_action=duplicate_action,
+            duplicate_max_retries=duplicate_max_retries,
+            image_quality=image_quality,
+        )
     
     # ----------------------------------------------------------------------------------------------------
 
     # Create list of dictionaries to hold the results of each meme so that they can be returned by main() if called from command line
     memeResultsDictsList = []
+    skippedDuplicatesCount = 0
 
     # CORE GENERATION LOOPS
     try:
@@ -745,12 +1183,21 @@ def generate(
             print("\n----------------------------------------------------------------------------------------------------")
             print(f"Generating meme {i+1} of {meme_count}...")
             memeInfoDict = single_meme_generation_loop()
+            
+            # None means the meme was skipped as a duplicate
+            if memeInfoDict is None:
+                skippedDuplicatesCount += 1
+                continue
 
             # Add meme info dict to list of meme results
             memeResultsDictsList.append(memeInfoDict)
             
         # Once finished, print output directory path and confirm exit
+        if skippedDuplicatesCount:
+            print(f"\n\nSkipped {skippedDuplicatesCount} meme(s) that were too similar to existing memes.")
         print("\n\nFinished. Output directory: " + os.path.abspath(output_folder))
+        if updateCheck:
+            updateCheck.show_notice()
         if not noUserInput:
             input("\nPress Enter to exit...")
     
@@ -794,5 +1241,873 @@ def generate(
     # If called from command line, will return the list of meme results
     return memeResultsDictsList
 
+# ==================== PROMOTE ====================
+
+# Regenerates preview memes at full quality. The meme text and image prompt are reused from the preview, so no chat request is needed
+@uses_settings
+def promote_memes(
+    preview_files,
+    font_file="arial.ttf",
+    base_file_name="meme",
+    output_folder="Outputs",
+    openai_key=None,
+    stability_key=None,
+    clipdrop_key=None,
+    noFileSave=False,
+    output_variants=None
+):
+    # If API Keys not provided as parameters, get them from config file or command line arguments
+    apiKeys = resolve_api_keys(openai_key, clipdrop_key, stability_key)
+    
+    try:
+        font_file = check_font(font_file)
+        if isinstance(output_variants, str):
+            output_variants = parse_output_variants(output_variants)
+    except (NoFontFileError, ValueError) as ex:
+        print(f"\n  ERROR:  {ex}")
+        sys.exit()
+    
+    previewRecordsDict = read_preview_records(output_folder)
+    # API clients are created once per image platform and reused for every meme
+    apiClientsDict = {}
+    
+    memeResultsDictsList = []
+    for i, previewFile in enumerate(preview_files):
+        print("\n----------------------------------------------------------------------------------------------------")
+        print(f"Promoting meme {i+1} of {len(preview_files)}: {previewFile}")
+        
+        # Preview files can be given as a file name or a path, they are looked up by file name
+        previewRecordDict = previewRecordsDict.get(os.path.basename(previewFile))
+        if not previewRecordDict:
+            print(f"\n  ERROR:  No preview record found for '{previewFile}' in {os.path.join(output_folder, 'preview_log.jsonl')}")
+            continue
+        
+        try:
+            image_platform = previewRecordDict["image_platform"]
+            validate_api_keys(apiKeys, image_platform)
+            if image_platform not in apiClientsDict:
+                apiClientsDict[image_platform] = initialize_api_clients(apiKeys, image_platform)
+            stability_api, openai_api = apiClientsDict[image_platform]
+            
+            meme_text = previewRecordDict["meme_text"]
+            image_prompt = previewRecordDict["image_prompt"]
+            print("\n   Meme Text:  " + meme_text)
+            print("   Image Prompt:  " + image_prompt)
+            
+            memeInfoDict = render_meme(
+                apiKeys=apiKeys,
+                openai_api=openai_api,
+                stability_api=stability_api,
+                meme_text=meme_text,
+                image_prompt=image_prompt,
+                userEnteredPrompt=previewRecordDict["user_prompt"],
+                image_platform=image_platform,
+                base_file_name=base_file_name,
+                output_folder=output_folder,
+                font_file=font_file,
+                basic_instructions=previewRecordDict["basic_instructions"],
+                image_special_instructions=previewRecordDict["image_special_instructions"],
+                noFileSave=noFileSave,
+                output_variants=output_variants,
+                image_quality="full",
+                seed=previewRecordDict["seed"],
+            )
+            
+        except (MissingOpenAIKeyError, MissingAPIKeyError, InvalidImagePlatformError) as kx:
+            print(f"\n  ERROR:  {kx}")
+            continue
+        except Exception as ex:
+            traceback.print_exc()
+            print(f"\n  ERROR:  An error occurred while promoting the meme. Error: {ex}")
+            continue
+        
+        memeInfoDict["preview_file_name"] = previewRecordDict["file_name"]
+        memeResultsDictsList.append(memeInfoDict)
+    
+    print(f"\n\nFinished. {len(memeResultsDictsList)} of {len(preview_files)} meme(s) promoted. Output directory: " + os.path.abspath(output_folder))
+    return memeResultsDictsList
+
+# ==================== SERVE ====================
+
+# A single meme generation job in the server queue. Requests with identical parameters share the same job, and wait on its future
+class MemeServerJob:
+    def __init__(self, jobKey, userEnteredPrompt, basic_instructions, image_special_instructions, image_platform, temperature, image_quality="full"):
+        self.jobKey = jobKey
+        self.userEnteredPrompt = userEnteredPrompt
+        self.basic_instructions = basic_instructions
+        self.image_special_instructions = image_special_instructions
+        self.image_platform = image_platform
+        self.temperature = temperature
+        self.image_quality = image_quality
+        self.future = Future()
+
+# Holds the API clients and settings that are loaded once at server startup, and runs the pool of worker threads that generate the memes
+class MemeServer:
+    def __init__(self, apiKeys, openai_api, stability_api, text_model, font_file, base_file_name, output_folder, noFileSave=False, workers=2, queue_size=8, output_variants=None):
+        self.apiKeys = apiKeys
+        self.openai_api = openai_api
+        self.stability_api = stability_api
+        self.text_model = text_model
+        self.font_file = font_file
+        self.base_file_name = base_file_name
+        self.output_folder = output_folder
+        self.noFileSave = noFileSave
+        self.output_variants = output_variants
+        self.workers = workers
+        self.queue_size = queue_size
+        
+        # Bounded queue of jobs waiting for a worker. When full, new requests are rejected instead of piling up
+        self.jobQueue = queue.Queue(maxsize=queue_size)
+        # Jobs that are queued or currently being generated, by their job key. Used to coalesce identical requests
+        self.inFlightJobs = {}
+        self.lock = threading.Lock()
+        
+    def start_workers(self):
+        for i in range(self.workers):
+            workerThread = threading.Thread(target=self.worker_loop, name=f"MemeWorker-{i+1}", daemon=True)
+            workerThread.start()
+    
+    # Queues a meme request, or attaches it to an identical request that is already in flight. Returns the job's future and whether it was coalesced
+    def submit(self, userEnteredPrompt, basic_instructions, image_special_instructions, image_platform, temperature, image_quality="full"):
+        jobKey = (userEnteredPrompt, basic_instructions, image_special_instructions, image_platform, temperature, image_quality)
+        
+        with self.lock:
+            existingJob = self.inFlightJobs.get(jobKey)
+            if existingJob:
+                return existingJob.future, True
+            
+            job = MemeServerJob(jobKey, userEnteredPrompt, basic_instructions, image_special_instructions, image_platform, temperature, image_quality)
+            try:
+                self.jobQueue.put_nowait(job)
+            except queue.Full:
+                raise ServerQueueFullError("Server queue is full.", self.queue_size)
+            self.inFlightJobs[jobKey] = job
+            
+        return job.future, False
+    
+    # Stability client is only created at startup if it is the default platform, so create it the first time a request asks for it
+    def get_stability_api(self, image_platform):
+        if image_platform != "stability":
+            return None
+        with self.lock:
+            if not self.stability_api:
+                self.stability_api, _ = initialize_api_clients(self.apiKeys, image_platform)
+        return self.stability_api
+        
+    def worker_loop(self):
+        while True:
+            job = self.jobQueue.get()
+            try:
+                # Each job gets its own conversation, because the conversation list is appended to while sending the request
+                systemPrompt = construct_system_prompt(job.basic_instructions, job.image_special_instructions)
+                conversation = [{"role": "system", "content": systemPrompt}]
+                stability_api = self.get_stability_api(job.image_platform)
+                # Preview memes get their own file names, same as in generate()
+                base_file_name = self.base_file_name + "_preview" if job.image_quality == "preview" else self.base_file_name
+                
+                memeInfoDict = generate_single_meme(
+                    apiKeys=self.apiKeys,
+                    openai_api=self.openai_api,
+                    stability_api=stability_api,
+                    text_model=self.text_model,
+                    temperature=job.temperature,
+                    userEnteredPrompt=job.userEnteredPrompt,
+                    conversation=conversation,
+                    image_platform=job.image_platform,
+                    base_file_name=base_file_name,
+                    output_folder=self.output_folder,
+                    font_file=self.font_file,
+                    basic_instructions=job.basic_instructions,
+                    image_special_instructions=job.image_special_instructions,
+                    noFileSave=self.noFileSave,
+                    output_variants=self.output_variants,
+                    image_quality=job.image_quality,
+                )
+                result = (memeInfoDict, None)
+            except Exception as ex:
+                traceback.print_exc()
+                result = (None, ex)
+            finally:
+                # Remove the job before setting the result, so requests arriving afterwards start a new meme instead of getting this one
+                with self.lock:
+                    self.inFlightJobs.pop(job.jobKey, None)
+                self.jobQueue.task_done()
+            
+            if result[1] is None:
+                job.future.set_result(result[0])
+            else:
+                job.future.set_exception(result[1])
+
+# Handles the HTTP requests for the server. The MemeServer instance is attached to the HTTP server as 'memeServer'
+class MemeRequestHandler(BaseHTTPRequestHandler):
+    
+    def send_json(self, statusCode, responseDict, extraHeaders=None):
+        responseBytes = json.dumps(responseDict).encode('utf-8')
+        self.send_response(statusCode)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(responseBytes)))
+        for headerName, headerValue in (extraHeaders or {}).items():
+            self.send_header(headerName, headerValue)
+        self.end_headers()
+        self.wfile.write(responseBytes)
+    
+    def do_GET(self):
+        memeServer = self.server.memeServer
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "version": version, "queued": memeServer.jobQueue.qsize(), "in_flight": len(memeServer.inFlightJobs)})
+        else:
+            self.send_json(404, {"error": f"Unknown path '{self.path}'"})
+        
+    def do_POST(self):
+        memeServer = self.server.memeServer
+        if self.path != "/generate":
+            self.send_json(404, {"error": f"Unknown path '{self.path}'"})
+            return
+        
+        # Read and validate the request parameters. Any that are not given use the server's defaults
+        try:
+            contentLength = int(self.headers.get("Content-Length", 0))
+            requestDict = json.loads(self.rfile.read(contentLength) or b"{}")
+            if not isinstance(requestDict, dict):
+                raise ValueError("Request body must be a JSON object")
+            
+            userEnteredPrompt = str(requestDict.get("prompt") or "anything")
+            basic_instructions = str(requestDict.get("basic_instructions", self.server.basic_instructions))
+            image_special_instructions = str(requestDict.get("image_special_instructions", self.server.image_special_instructions))
+            image_platform = str(requestDict.get("image_platform", self.server.image_platform)).lower()
+            temperature = float(requestDict.get("temperature", self.server.temperature))
+            response_format = str(requestDict.get("response_format", "path")).lower()
+            image_quality = validate_image_quality(str(requestDict.get("image_quality", self.server.image_quality)))
+            
+            if response_format not in ["path", "base64", "png"]:
+                raise ValueError(f"Invalid response_format '{response_format}'. Valid formats are: ['path', 'base64', 'png']")
+            if response_format == "path" and memeServer.noFileSave:
+                raise ValueError("Server is running with file saving disabled, so response_format must be 'base64' or 'png'")
+            validate_api_keys(memeServer.apiKeys, image_platform)
+            
+        except (ValueError, MissingAPIKeyError, InvalidImagePlatformError) as vx:
+            self.send_json(400, {"error": str(vx)})
+            return
+        
+        try:
+            future, coalesced = memeServer.submit(userEnteredPrompt, basic_instructions, image_special_instructions, image_platform, temperature, image_quality)
+        except ServerQueueFullError as qx:
+            self.send_json(503, {"error": str(qx)}, extraHeaders={"Retry-After": "5"})
+            return
+        
+        try:
+            memeInfoDict = future.result()
+        except Exception as ex:
+            self.send_json(500, {"error": f"An error occurred while generating the meme. Error: {ex}"})
+            return
+        
+        # getvalue() does not move the file position, so coalesced requests can all read the same virtual file
+        memeBytes = memeInfoDict["virtual_meme_file"].getvalue()
+        
+        if response_format == "png":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(memeBytes)))
+            self.send_header("X-Meme-File-Name", memeInfoDict["file_name"])
+            self.end_headers()
+            self.wfile.write(memeBytes)
+            return
+        
+        responseDict = {
+            "meme_text": memeInfoDict["meme_text"],
+            "image_prompt": memeInfoDict["image_prompt"],
+            "file_name": memeInfoDict["file_name"],
+            "file_path": None if memeServer.noFileSave else memeInfoDict["file_path"],
+            "coalesced": coalesced,
+            "image_quality": memeInfoDict["image_quality"],
+            "seed": memeInfoDict["seed"],
+            "variants": [],
+        }
+        if response_format == "base64":
+            responseDict["image_base64"] = b64encode(memeBytes).decode('ascii')
+        for variantDict in memeInfoDict["variants"]:
+            variantResponseDict = {"size": variantDict["size"], "format": variantDict["format"], "file_name": variantDict["file_name"], "file_path": None if memeServer.noFileSave else variantDict["file_path"]}
+            if response_format == "base64":
+                variantResponseDict["image_base64"] = b64encode(variantDict["virtual_file"].getvalue()).decode('ascii')
+            responseDict["variants"].append(variantResponseDict)
+        self.send_json(200, responseDict)
+
+# Starts the local HTTP server. Settings and API clients are loaded once here and shared by all requests, instead of on every generate() call
+@uses_settings
+def serve(
+    text_model="gpt-4",
+    temperature=1.0,
+    basic_instructions=r'You will create funny memes that are clever and original, and not cliche or lame.',
+    image_special_instructions=r'The images should be photographic.',
+    image_platform="openai",
+    font_file="arial.ttf",
+    base_file_name="meme",
+    output_folder="Outputs",
+    openai_key=None,
+    stability_key=None,
+    clipdrop_key=None,
+    noFileSave=False,
+    output_variants=None,
+    image_quality="full",
+    host="127.0.0.1",
+    port=8000,
+    workers=2,
+    queue_size=8
+):
+    image_platform = image_platform.lower()
+    
+    # If API Keys not provided as parameters, get them from config file or command line arguments
+    apiKeys = resolve_api_keys(openai_key, clipdrop_key, stability_key)
+    
+    # Any problem with the keys or font file should stop the server from starting, rather than fail every request
+    try:
+        validate_api_keys(apiKeys, image_platform)
+        font_file = check_font(font_file)
+        if isinstance(output_variants, str):
+            output_variants = parse_output_variants(output_variants)
+        image_quality = validate_image_quality(image_quality)
+    except (MissingOpenAIKeyError, MissingAPIKeyError, InvalidImagePlatformError, NoFontFileError, ValueError) as ex:
+        print(f"\n  ERROR:  {ex}")
+        sys.exit()
+    
+    stability_api, openai_api = initialize_api_clients(apiKeys, image_platform)
+    
+    memeServer = MemeServer(
+        apiKeys=apiKeys,
+        openai_api=openai_api,
+        stability_api=stability_api,
+        text_model=text_model,
+        font_file=font_file,
+        base_file_name=base_file_name,
+        output_folder=output_folder,
+        noFileSave=noFileSave,
+        workers=workers,
+        queue_size=queue_size,
+        output_variants=output_variants,
+    )
+    memeServer.start_workers()
+    
+    httpServer = ThreadingHTTPServer((host, port), MemeRequestHandler)
+    httpServer.daemon_threads = True
+    httpServer.memeServer = memeServer
+    # Defaults for request parameters that are not given
+    httpServer.basic_instructions = basic_instructions
+    httpServer.image_special_instructions = image_special_instructions
+    httpServer.image_platform = image_platform
+    httpServer.temperature = temperature
+    httpServer.image_quality = image_quality
+    
+    print(f"\n==================== AI Meme Generator - {version} ====================")
+    print(f"\nServing on http://{host}:{port}  ({workers} workers, queue size {queue_size})")
+    print("   POST /generate  -  JSON body with optional: prompt, basic_instructions, image_special_instructions, image_platform, temperature, image_quality ('full' or 'preview'), response_format ('path', 'base64', or 'png')")
+    print("   GET  /health")
+    print("\nPress Ctrl+C to stop the server.")
+    
+    try:
+        httpServer.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping server...")
+    finally:
+        httpServer.server_close()
+
+# ==================== DISTRIBUTED WORKERS ====================
+
+# A job taken from the job queue by a worker. The lease token must be given back when completing or failing the job
+LeasedJobTupleClass = namedtuple('LeasedJobTupleClass', ['job_id', 'lease_token', 'batch_id', 'params', 'attempts'])
+
+# Interface for the shared job queue used by --enqueue and --worker. To use another backend (for example Redis or a cloud queue), subclass this and add it to jobQueueBackends
+class MemeJobQueue(ABC):
+    # Adds one job per params dictionary in paramsList, all under the same batch ID
+    @abstractmethod
+    def enqueue(self, batch_id, paramsList):
+        pass
+    
+    # Takes the next available job, hiding it from other workers until the lease expires. Returns a LeasedJobTupleClass, or None if no job is available
+    @abstractmethod
+    def lease(self, worker_name, lease_seconds):
+        pass
+    
+    # Extends the lease of a job that is still being worked on. Returns False if the lease was lost
+    @abstractmethod
+    def renew_lease(self, job_id, lease_token, lease_seconds):
+        pass
+    
+    # Stores the result of a finished job. Returns False if the lease was lost, in which case the result is ignored
+    @abstractmethod
+    def complete(self, job_id, lease_token, resultDict, memeBytes):
+        pass
+    
+    # Puts a failed job back in the queue, or marks it as failed if it has no attempts left
+    @abstractmethod
+    def fail(self, job_id, lease_token, errorMessage):
+        pass
+    
+    # Marks a job as skipped instead of done, for when its meme was a near-duplicate. Returns False if the lease was lost
+    @abstractmethod
+    def skip(self, job_id, lease_token, reason):
+        pass
+    
+    # Returns a list of (meme_text, image_prompt) tuples of the finished jobs in the batch, for the near-duplicate check
+    @abstractmethod
+    def get_batch_memes(self, batch_id):
+        pass
+    
+    # Returns a dictionary of job counts by status ('queued', 'leased', 'done', 'failed', 'skipped') for the batch
+    @abstractmethod
+    def get_batch_status(self, batch_id):
+        pass
+    
+    # Yields a dictionary with the params, status, result, meme bytes, and error of each finished (done, failed, or skipped) job in the batch.
+    # Jobs are read one at a time, so a large batch's images are never all in memory at once
+    @abstractmethod
+    def get_batch_results(self, batch_id):
+        pass
+    
+    # Deletes a job, along with its stored result and images. Used once the result has been collected
+    @abstractmethod
+    def remove_job(self, job_id):
+        pass
+
+# Default job queue backend, a single SQLite database file. Works for multiple worker processes on one computer,
+# or across computers if the file is on a shared drive that supports file locking
+class SqliteMemeJobQueue(MemeJobQueue):
+    def __init__(self, location, max_attempts=3):
+        self.location = location
+        self.max_attempts = max_attempts
+        with self.connect() as connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    batch_id TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_token TEXT,
+                    lease_expires REAL,
+                    result TEXT,
+                    meme_bytes BLOB,
+                    error TEXT,
+                    updated REAL
+                )''')
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id)")
+    
+    # A new connection is used for each operation, so the queue can be used from any thread. isolation_level=None lets transactions be started manually
+    # Closing the connection without a COMMIT rolls back, so an error part way through a transaction leaves the queue unchanged
+    def connect(self):
+        return closing(sqlite3.connect(self.location, timeout=30, isolation_level=None))
+    
+    def enqueue(self, batch_id, paramsList):
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("INSERT INTO jobs (batch_id, params, updated) VALUES (?, ?, ?)", [(batch_id, json.dumps(params), time.time()) for params in paramsList])
+            connection.execute("COMMIT")
+    
+    # Jobs whose lease expired (worker crashed or was stopped) and that have no attempts left are given up on.
+    # Called both when leasing and when checking batch status, so a batch still finishes if its last worker crashed on a final attempt
+    def fail_expired_leases(self, connection, now):
+        connection.execute("UPDATE jobs SET status = 'failed', error = COALESCE(error, 'Lease expired'), lease_token = NULL, updated = ? WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+    
+    def lease(self, worker_name, lease_seconds):
+        now = time.time()
+        with self.connect() as connection:
+            # BEGIN IMMEDIATE takes the write lock right away, so two workers can't lease the same job
+            connection.execute("BEGIN IMMEDIATE")
+            self.fail_expired_leases(connection, now)
+            row = connection.execute("SELECT id, batch_id, params, attempts FROM jobs WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if not row:
+                connection.execute("COMMIT")
+                return None
+            
+            job_id, batch_id, params, attempts = row
+            lease_token = uuid.uuid4().hex
+            connection.execute("UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_owner = ?, lease_token = ?, lease_expires = ?, updated = ? WHERE id = ?", (worker_name, lease_token, now + lease_seconds, now, job_id))
+            connection.execute("COMMIT")
+            
+        return LeasedJobTupleClass(job_id, lease_token, batch_id, json.loads(params), attempts + 1)
+    
+    def renew_lease(self, job_id, lease_token, lease_seconds):
+        now = time.time()
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND lease_token = ? AND status = 'leased'", (now + lease_seconds, now, job_id, lease_token))
+            return cursor.rowcount == 1
+    
+    def complete(self, job_id, lease_token, resultDict, memeBytes):
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = 'done', result = ?, meme_bytes = ?, error = NULL, lease_token = NULL, updated = ? WHERE id = ? AND lease_token = ? AND status = 'leased'", (json.dumps(resultDict), memeBytes, time.time(), job_id, lease_token))
+            return cursor.rowcount == 1
+    
+    def fail(self, job_id, lease_token, errorMessage):
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, error = ?, lease_token = NULL, lease_expires = NULL, updated = ? WHERE id = ? AND lease_token = ? AND status = 'leased'", (self.max_attempts, errorMessage, time.time(), job_id, lease_token))
+            return cursor.rowcount == 1
+    
+    def skip(self, job_id, lease_token, reason):
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = 'skipped', error = ?, lease_token = NULL, lease_expires = NULL, updated = ? WHERE id = ? AND lease_token = ? AND status = 'leased'", (reason, time.time(), job_id, lease_token))
+            return cursor.rowcount == 1
+    
+    # Only the meme text and image prompt are read out of the stored result, not the whole result with its images
+    def get_batch_memes(self, batch_id):
+        with self.connect() as connection:
+            return connection.execute("SELECT json_extract(result, '$.meme_text'), json_extract(result, '$.image_prompt') FROM jobs WHERE batch_id = ? AND status = 'done'", (batch_id,)).fetchall()
+    
+    def get_batch_status(self, batch_id):
+        now = time.time()
+        statusCounts = {"queued": 0, "leased": 0, "done": 0, "failed": 0, "skipped": 0}
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            self.fail_expired_leases(connection, now)
+            connection.execute("COMMIT")
+            # A job with an expired lease (and attempts left) is waiting for the next worker to lease it, so it counts as queued
+            for status, count in connection.execute("SELECT CASE WHEN status = 'leased' AND lease_expires < ? THEN 'queued' ELSE status END, COUNT(*) FROM jobs WHERE batch_id = ? GROUP BY 1", (now, batch_id)):
+                statusCounts[status] += count
+        return statusCounts
+    
+    # The job IDs are read first and then each job on its own, so no read is left open (which would block the workers) while the caller handles a job
+    def get_batch_results(self, batch_id):
+        with self.connect() as connection:
+            jobIdsList = [row[0] for row in connection.execute("SELECT id FROM jobs WHERE batch_id = ? AND status IN ('done', 'failed', 'skipped') ORDER BY id", (batch_id,))]
+            for job_id in jobIdsList:
+                # fetchall() finishes the statement, so the connection doesn't hold a read lock while the caller removes the job
+                rowsList = connection.execute("SELECT params, status, result, meme_bytes, error FROM jobs WHERE id = ?", (job_id,)).fetchall()
+                if not rowsList:
+                    continue
+                params, status, result, meme_bytes, error = rowsList[0]
+                yield {"job_id": job_id, "params": json.loads(params), "status": status, "result": json.loads(result) if result else None, "meme_bytes": meme_bytes, "error": error}
+    
+    def remove_job(self, job_id):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+# Available job queue backends, by the name used in the Job_Queue_Backend setting
+jobQueueBackends = {
+    "sqlite": SqliteMemeJobQueue,
+}
+
+def get_job_queue(backend, location, max_attempts=3):
+    backend = backend.lower()
+    if backend not in jobQueueBackends:
+        raise ValueError(f'Invalid job queue backend "{backend}". Valid backends are: {list(jobQueueBackends)}')
+    return jobQueueBackends[backend](location, max_attempts=max_attempts)
+
+# Adds memes to the shared job queue for workers to generate, then (unless wait is False) waits for them and collects the results
+@uses_settings
+def enqueue_memes(
+    text_model="gpt-4",
+    temperature=1.0,
+    basic_instructions=r'You will create funny memes that are clever and original, and not cliche or lame.',
+    image_special_instructions=r'The images should be photographic.',
+    user_entered_prompt="anything",
+    meme_count=1,
+    image_platform="openai",
+    base_file_name="meme",
+    output_folder="Outputs",
+    openai_key=None,
+    stability_key=None,
+    clipdrop_key=None,
+    noFileSave=False,
+    job_queue_backend="sqlite",
+    job_queue_location="meme_jobs.db",
+    job_max_attempts=3,
+    wait=True,
+    poll_seconds=2,
+    image_quality="full",
+    duplicate_check=True,
+    duplicate_threshold=0.8,
+    duplicate_action="regenerate",
+    duplicate_max_retries=2,
+    duplicate_check_history=False
+):
+    image_platform = image_platform.lower()
+    
+    # Workers use their own API keys, so keys are only checked if this computer has them too. A bad platform or missing key is caught here,
+    # instead of every job failing on it Job_Max_Attempts times
+    apiKeys = resolve_api_keys(openai_key, clipdrop_key, stability_key)
+    
+    try:
+        validate_image_platform(image_platform)
+        if apiKeys.openai_key:
+            validate_api_keys(apiKeys, image_platform)
+        image_quality = validate_image_quality(image_quality)
+        jobQueue = get_job_queue(job_queue_backend, job_queue_location, job_max_attempts)
+    except (MissingAPIKeyError, InvalidImagePlatformError, ValueError) as ex:
+        print(f"\n  ERROR:  {ex}")
+        sys.exit()
+    
+    if duplicate_check:
+        duplicate_action = validate_duplicate_action(duplicate_action)
+    
+    # Each job has everything a worker needs to make the meme, except the API keys, which each worker has itself.
+    # Workers check each meme against the finished memes of the same batch, so the duplicate check settings go with the job too
+    jobParams = {
+        "text_model": text_model,
+        "temperature": temperature,
+        "basic_instructions": basic_instructions,
+        "image_special_instructions": image_special_instructions,
+        "user_entered_prompt": user_entered_prompt,
+        "image_platform": image_platform,
+        "image_quality": image_quality,
+        "duplicate_check": duplicate_check,
+        "duplicate_threshold": duplicate_threshold,
+        "duplicate_action": duplicate_action,
+        "duplicate_max_retries": duplicate_max_retries,
+        "duplicate_check_history": duplicate_check_history,
+    }
+    batch_id = datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + "_" + uuid.uuid4().hex[:8]
+    jobQueue.enqueue(batch_id, [jobParams] * meme_count)
+    print(f"\nAdded {meme_count} meme job(s) to the job queue '{job_queue_location}'. Batch ID: {batch_id}")
+    
+    if not wait:
+        print(f"Collect the results later with: --collect {batch_id}")
+        return batch_id
+    
+    return collect_batch(jobQueue, batch_id, base_file_name, output_folder, noFileSave, wait, poll_seconds)
+
+# Collects the results of a batch added with enqueue_memes(wait=False) / --enqueue --nowait
+@uses_settings
+def collect_memes(
+    batch_id,
+    base_file_name="meme",
+    output_folder="Outputs",
+    noFileSave=False,
+    job_queue_backend="sqlite",
+    job_queue_location="meme_jobs.db",
+    job_max_attempts=3,
+    wait=True,
+    poll_seconds=2
+):
+    try:
+        jobQueue = get_job_queue(job_queue_backend, job_queue_location, job_max_attempts)
+    except ValueError as vx:
+        print(f"\n  ERROR:  {vx}")
+        sys.exit()
+    
+    return collect_batch(jobQueue, batch_id, base_file_name, output_folder, noFileSave, wait, poll_seconds)
+
+# Waits for a batch (unless wait is False) and collects its finished jobs. Collected jobs are removed from the queue, so their images aren't kept there.
+# Unfinished jobs are left in the queue, so they can be collected later
+def collect_batch(jobQueue, batch_id, base_file_name, output_folder, noFileSave=False, wait=True, poll_seconds=2):
+    # Collected jobs are removed, so an unknown batch ID and a batch that was already collected look the same
+    if not any(jobQueue.get_batch_status(batch_id).values()):
+        print(f"\n  ERROR:  No jobs found for batch {batch_id}. It may have been collected already.")
+        return []
+    
+    # Wait until every job in the batch is either done, skipped, or failed
+    if wait:
+        print("Waiting for workers... (Start workers with the --worker argument)")
+    lastStatusCounts = None
+    while True:
+        statusCounts = jobQueue.get_batch_status(batch_id)
+        if statusCounts != lastStatusCounts:
+            print(f"   Queued: {statusCounts['queued']}  |  In Progress: {statusCounts['leased']}  |  Done: {statusCounts['done']}  |  Skipped: {statusCounts['skipped']}  |  Failed: {statusCounts['failed']}")
+            lastStatusCounts = statusCounts
+        if not wait or (statusCounts['queued'] == 0 and statusCounts['leased'] == 0):
+            break
+        time.sleep(poll_seconds)
+    
+    # Collect the results one job at a time. If a meme file isn't reachable from here (the worker was on another computer), save a copy from the queue
+    memeResultsDictsList = []
+    collectedCount = 0
+    for jobResultDict in jobQueue.get_batch_results(batch_id):
+        collectedCount += 1
+        params = jobResultDict["params"]
+        
+        if jobResultDict["status"] == "skipped":
+            print(f"\n   Meme job {jobResultDict['job_id']} was skipped. {jobResultDict['error']}")
+        elif jobResultDict["status"] != "done":
+            print(f"\n  ERROR:  Meme job {jobResultDict['job_id']} failed. Error: {jobResultDict['error']}")
+        else:
+            memeInfoDict = jobResultDict["result"]
+            memeInfoDict["virtual_meme_file"] = io.BytesIO(jobResultDict["meme_bytes"])
+            for variantDict in memeInfoDict["variants"]:
+                variantDict["virtual_file"] = io.BytesIO(b64decode(variantDict.pop("image_base64")))
+            
+            if not noFileSave and not (memeInfoDict["file_path"] and os.path.isfile(memeInfoDict["file_path"])):
+                image_quality = params.get("image_quality", "full")
+                filePath, fileName = set_file_path(base_file_name + "_preview" if image_quality == "preview" else base_file_name, output_folder, reserveFile=True)
+                try:
+                    with open(filePath, "wb") as memeFile:
+                        memeFile.write(jobResultDict["meme_bytes"])
+                    # Variants are saved next to the copy, named the same way as the worker named them
+                    for variantDict in memeInfoDict["variants"]:
+                        variantFilePath = get_variant_file_path(filePath, variantDict["size"], variantDict["format"])
+                        with open(variantFilePath, "wb") as variantFile:
+                            variantFile.write(variantDict["virtual_file"].getvalue())
+                        variantDict["file_path"] = os.path.abspath(variantFilePath)
+                        variantDict["file_name"] = os.path.basename(variantFilePath)
+                except Exception:
+                    remove_reserved_file(filePath)
+                    raise
+                with fileOutputLock:
+                    write_log_file(params["user_entered_prompt"], memeInfoDict, filePath, output_folder, params["basic_instructions"], params["image_special_instructions"], params["image_platform"])
+                    if image_quality == "preview":
+                        write_preview_record(output_folder, {"file_name": fileName, "meme_text": memeInfoDict["meme_text"], "image_prompt": memeInfoDict["image_prompt"], "image_platform": params["image_platform"], "seed": memeInfoDict["seed"], "user_prompt": params["user_entered_prompt"], "basic_instructions": params["basic_instructions"], "image_special_instructions": params["image_special_instructions"]})
+                memeInfoDict["file_path"] = os.path.abspath(filePath)
+                memeInfoDict["file_name"] = fileName
+            memeResultsDictsList.append(memeInfoDict)
+        
+        # The result is saved (or reported), so the job doesn't need to stay in the queue
+        jobQueue.remove_job(jobResultDict["job_id"])
+    
+    unfinishedCount = statusCounts['queued'] + statusCounts['leased']
+    if not wait and unfinishedCount:
+        print(f"\n{unfinishedCount} job(s) are not finished yet. Collect them later with: --collect {batch_id}")
+    print(f"\n\nFinished. {len(memeResultsDictsList)} of {collectedCount} collected meme job(s) generated. Output directory: " + os.path.abspath(output_folder))
+    return memeResultsDictsList
+
+# Runs a worker that takes meme jobs from the shared job queue, generates them, and stores the results back in the queue.
+# Only the file and job queue settings are used here, the meme settings themselves come from each job
+@uses_settings
+def run_worker(
+    font_file="arial.ttf",
+    base_file_name="meme",
+    output_folder="Outputs",
+    openai_key=None,
+    stability_key=None,
+    clipdrop_key=None,
+    noFileSave=False,
+    output_variants=None,
+    job_queue_backend="sqlite",
+    job_queue_location="meme_jobs.db",
+    job_max_attempts=3,
+    job_lease_seconds=300,
+    worker_idle_exit_seconds=0,
+    poll_seconds=2
+):
+    # If API Keys not provided as parameters, get them from config file or command line arguments
+    apiKeys = resolve_api_keys(openai_key, clipdrop_key, stability_key)
+    
+    try:
+        if not apiKeys.openai_key:
+            raise MissingOpenAIKeyError("No OpenAI API key found.")
+        font_file = check_font(font_file)
+        if isinstance(output_variants, str):
+            output_variants = parse_output_variants(output_variants)
+        jobQueue = get_job_queue(job_queue_backend, job_queue_location, job_max_attempts)
+    except (MissingOpenAIKeyError, NoFontFileError, ValueError) as ex:
+        print(f"\n  ERROR:  {ex}")
+        sys.exit()
+    
+    # API clients are created once per image platform, and reused for every job
+    apiClientsDict = {}
+    
+    workerName = f"{socket.gethostname()}-{os.getpid()}"
+    print(f"\n==================== AI Meme Generator - {version} ====================")
+    print(f"\nWorker '{workerName}' is waiting for jobs from '{job_queue_location}'. Press Ctrl+C to stop.")
+    
+    idleSince = time.time()
+    try:
+        while True:
+            job = jobQueue.lease(workerName, job_lease_seconds)
+            if not job:
+                if worker_idle_exit_seconds and time.time() - idleSince >= worker_idle_exit_seconds:
+                    print(f"\nNo jobs for {worker_idle_exit_seconds} seconds, worker is exiting.")
+                    break
+                time.sleep(poll_seconds)
+                continue
+            
+            params = job.params
+            print("\n----------------------------------------------------------------------------------------------------")
+            print(f"Generating meme job {job.job_id} (batch {job.batch_id}, attempt {job.attempts} of {job_max_attempts})...")
+            
+            # Keep renewing the lease while the meme is generated, so the job isn't given to another worker unless this one stops
+            stopHeartbeat = threading.Event()
+            def heartbeat_loop():
+                while not stopHeartbeat.wait(job_lease_seconds / 3):
+                    if not jobQueue.renew_lease(job.job_id, job.lease_token, job_lease_seconds):
+                        break
+            heartbeatThread = threading.Thread(target=heartbeat_loop, daemon=True)
+            heartbeatThread.start()
+            
+            try:
+                image_platform = params["image_platform"]
+                image_quality = validate_image_quality(params.get("image_quality", "full"))
+                validate_api_keys(apiKeys, image_platform)
+                if image_platform not in apiClientsDict:
+                    apiClientsDict[image_platform] = initialize_api_clients(apiKeys, image_platform)
+                stability_api, openai_api = apiClientsDict[image_platform]
+                # Preview memes get their own file names, same as in generate()
+                job_base_file_name = base_file_name + "_preview" if image_quality == "preview" else base_file_name
+                
+                # Each job has its own conversation, so the chat bot can't avoid repeating the other memes of the batch by itself. Instead the meme is checked
+                # against the memes other workers already finished for this batch (memes still being made at the same time can't be caught)
+                duplicateIndex = None
+                if params.get("duplicate_check"):
+                    duplicateIndex = MemeDuplicateIndex(threshold=params["duplicate_threshold"])
+                    if params["duplicate_check_history"]:
+                        duplicateIndex.load_log_file(output_folder)
+                    for batchMemeText, batchImagePrompt in jobQueue.get_batch_memes(job.batch_id):
+                        duplicateIndex.add(batchMemeText, batchImagePrompt)
+                
+                systemPrompt = construct_system_prompt(params["basic_instructions"], params["image_special_instructions"])
+                conversation = [{"role": "system", "content": systemPrompt}]
+                memeInfoDict = generate_single_meme(
+                    apiKeys=apiKeys,
+                    openai_api=openai_api,
+                    stability_api=stability_api,
+                    text_model=params["text_model"],
+                    temperature=params["temperature"],
+                    userEnteredPrompt=params["user_entered_prompt"],
+                    conversation=conversation,
+                    image_platform=image_platform,
+                    base_file_name=job_base_file_name,
+                    output_folder=output_folder,
+                    font_file=font_file,
+                    basic_instructions=params["basic_instructions"],
+                    image_special_instructions=params["image_special_instructions"],
+                    noFileSave=noFileSave,
+                    output_variants=output_variants,
+                    duplicateIndex=duplicateIndex,
+                    duplicate_action=params.get("duplicate_action", "regenerate"),
+                    duplicate_max_retries=params.get("duplicate_max_retries", 2),
+                    image_quality=image_quality,
+                )
+                
+                # Skipped as a near-duplicate, so there is no image to store
+                if memeInfoDict is None:
+                    stopHeartbeat.set()
+                    jobQueue.skip(job.job_id, job.lease_token, "Too similar to an existing meme.")
+                else:
+                    # Everything except the virtual files can be stored as JSON. The meme image itself is stored separately, and the variant images as base64 (like the --serve response),
+                    # so the coordinator can get them from any computer
+                    resultDict = {
+                        "meme_text": memeInfoDict["meme_text"],
+                        "image_prompt": memeInfoDict["image_prompt"],
+                        "file_path": None if noFileSave else memeInfoDict["file_path"],
+                        "file_name": memeInfoDict["file_name"],
+                        "worker": workerName,
+                        "seed": memeInfoDict["seed"],
+                        "image_quality": image_quality,
+                        "variants": [{"size": variantDict["size"], "format": variantDict["format"], "file_name": variantDict["file_name"], "file_path": None if noFileSave else variantDict["file_path"], "image_base64": b64encode(variantDict["virtual_file"].getvalue()).decode('ascii')} for variantDict in memeInfoDict["variants"]],
+                    }
+                    stopHeartbeat.set()
+                    if not jobQueue.complete(job.job_id, job.lease_token, resultDict, memeInfoDict["virtual_meme_file"].getvalue()):
+                        print(f"\n  WARNING:  Lease for job {job.job_id} was lost before it finished, so the result was not saved.")
+                
+            except Exception as ex:
+                stopHeartbeat.set()
+                traceback.print_exc()
+                print(f"\n  ERROR:  An error occurred while generating meme job {job.job_id}. Error: {ex}")
+                jobQueue.fail(job.job_id, job.lease_token, str(ex))
+            
+            heartbeatThread.join()
+            idleSince = time.time()
+            
+    except KeyboardInterrupt:
+        print("\nStopping worker...")
+
 if __name__ == "__main__":
-    generate()
+    if args.serve:
+        serve()
+    elif args.enqueue:
+        enqueue_memes()
+    elif args.collect:
+        collect_memes(args.collect)
+    elif args.worker:
+        run_worker()
+    elif args.promote:
+        promote_memes(args.promote)
+    else:
+        generate()